@@ -6,14 +6,24 @@ from supabase import create_client
 from postgrest import APIError
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
 import datetime as dt
-import os, json, shutil
+import os, io, json
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson  # C実装でマスターJSONの読み書きを高速化
+except ImportError:
+    orjson = None  # 無ければ標準jsonで代替
 
 import re, unicodedata
+from functools import lru_cache
 
+@lru_cache(maxsize=64)
 def normalize_email(s: str) -> str:
     # 前後空白を削り、全角→半角へ正規化（NFKC）
+    # rerunごとに同じ入力が来るのでメモ化しておく
     return unicodedata.normalize("NFKC", (s or "").strip())
 
 def sanitize_ascii_email(s: str) -> str:
@@ -23,7 +33,8 @@ def sanitize_ascii_email(s: str) -> str:
     # うっかり入った囲み記号などを端から除去（任意）
     return s.strip("()（）<>『』「」")
 
-EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}$")
+# ASCII限定の文字クラスなので、このパターン1回で形式と非ASCII混入を同時に弾ける
+EMAIL_RE = re.compile(r"\A[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}\Z")
 
 
 # ========== Page Config ==========
@@ -53,6 +64,13 @@ def est_1rm_epley(weight, reps):
         return None
     return float(weight) * (1.0 + float(reps) / 30.0)
 
+def _e1rm_vec(w: pd.Series, r: pd.Series) -> pd.Series:
+    """Epley式をSeries全体で一括計算（行ごとapplyより高速）"""
+    w = pd.to_numeric(w, errors="coerce")
+    r = pd.to_numeric(r, errors="coerce")
+    out = w * (1.0 + r / 30.0)
+    return out.where(r > 0)  # reps<=0 や欠損は NaN
+
 def _dedup_keep_order(seq):
     seen, out = set(), []
     for x in seq:
@@ -61,13 +79,16 @@ def _dedup_keep_order(seq):
             seen.add(x); out.append(x)
     return out
 
-def load_ex_master():
+@st.cache_data(show_spinner=False)
+def load_ex_master(mtime: float):
+    """種目マスターを読み込む（mtimeをキーにキャッシュ。ファイル更新時だけ再パース）"""
     if not os.path.exists(EX_JSON):
         save_ex_master(DEFAULT_EX)
         return DEFAULT_EX.copy()
     try:
-        with open(EX_JSON, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(EX_JSON, "rb") as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
         for k in DEFAULT_EX.keys():
             data.setdefault(k, [])
             data[k] = _dedup_keep_order(data[k])
@@ -75,18 +96,19 @@ def load_ex_master():
     except Exception:
         return DEFAULT_EX.copy()
 
+def _ex_master_mtime() -> float:
+    return os.path.getmtime(EX_JSON) if os.path.exists(EX_JSON) else 0.0
+
 def save_ex_master(data):
-    with open(EX_JSON, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        with open(EX_JSON, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(EX_JSON, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    load_ex_master.clear()  # 次のrerunで読み直す
+
 
-def backup_before_master_edit():
-    os.makedirs(os.path.join(DATA_DIR, "backup"), exist_ok=True)
-    ts = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
-    try:
-        shutil.copy2(EX_JSON, os.path.join(DATA_DIR, "backup", f"exercises_{ts}.json"))
-    except Exception:
-        pass
-    
 def y_domain(series, pad_ratio=0.05):
     """系列の最小/最大から少し余白を付けた表示範囲を返す"""
     s = pd.to_numeric(pd.Series(series), errors="coerce").dropna()
@@ -154,6 +176,17 @@ def normalize_sets_df(df: pd.DataFrame) -> pd.DataFrame:
         if c not in df.columns:
             df[c] = pd.NA
 
+    # 数値・文字列のdtypeをここで一括確定（下流での都度to_numericを減らす）
+    df[["set_no", "reps"]] = df[["set_no", "reps"]].apply(pd.to_numeric, errors="coerce")
+    df = df.astype({"set_no": "Int64", "reps": "Int64"})
+    df["weight_kg"] = pd.to_numeric(df["weight_kg"], errors="coerce")
+    df["note"] = df["note"].fillna("").astype("string")
+
+    # 種目・部位は辞書型（category）に。groupby/比較が文字列ではなく整数コードで走り、
+    # 高カーディナリティでもメモリを食わない
+    df["exercise"] = df["exercise"].astype("category")
+    df["bodypart"] = df["bodypart"].astype("category")
+
     # 日付をTimestamp化し、tzを外して day を作成
     ds = pd.to_datetime(df["date"], errors="coerce")
     try:
@@ -171,7 +204,16 @@ def normalize_sets_df(df: pd.DataFrame) -> pd.DataFrame:
 # ========== Supabase Client ==========
 SUPABASE_URL = st.secrets["SUPABASE_URL"]
 SUPABASE_KEY = st.secrets["SUPABASE_ANON_KEY"]
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+def get_supabase():
+    """クライアントはセッション内で使い回す（rerunごとのTLSセットアップを省く）。
+    postgrest.auth()でAuthorizationヘッダを書き換えるため、cache_resourceで
+    全セッション共有にすると他ユーザーのトークンで実行される恐れがある"""
+    if "sb_client" not in st.session_state:
+        st.session_state["sb_client"] = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return st.session_state["sb_client"]
+
+supabase = get_supabase()
 
 # セッション初期化＆トークンがあるときだけ付与（Noneでは呼ばない）
 st.session_state.setdefault("user", None)
@@ -196,11 +238,8 @@ with st.sidebar:
             li_pwd       = st.text_input("Password", type="password", key="li_pwd")
             if st.button("Sign in", key="btn_signin"):
                 li_email = normalize_email(li_email_raw)
-                if not li_email.isascii():
-                    st.error("メールアドレスに全角文字が含まれています。半角で入力してください。")
-                    st.stop()
                 if not EMAIL_RE.fullmatch(li_email):
-                    st.error("メール形式が正しくありません（例: name@example.com）。")
+                    st.error("メール形式が正しくありません（半角で、例: name@example.com）。")
                     st.stop()
                 try:
                     auth = supabase.auth.sign_in_with_password(
@@ -222,13 +261,9 @@ with st.sidebar:
             if st.button("Create account", key="btn_signup"):
                 # ここで正規化＆チェック（encodeは使わない）
                 su_email = normalize_email(su_email_raw)
-        
-                if not su_email.isascii():
-                    st.error("メールアドレスに全角文字が含まれています。半角で入力してください。")
-                    st.stop()
-        
+
                 if not EMAIL_RE.fullmatch(su_email):
-                    st.error("メールアドレスの形式が正しくありません（例: name@example.com）。")
+                    st.error("メールアドレスの形式が正しくありません（半角で、例: name@example.com）。")
                     st.stop()
         
                 try:
@@ -301,12 +336,15 @@ def _iso(v):
 
 from postgrest import APIError
 
+@st.cache_data(ttl=60, show_spinner=False)
 def db_load_sets(user_id: str) -> pd.DataFrame:
     try:
         res = (
             supabase.table("workouts")
             .select("id, user_id, date, exercise, bodypart, set_no, weight_kg, reps, note, ts")
             .eq("user_id", user_id)
+            # ダッシュボード表示用に直近1年へ絞る（PR判定とCSVは別ローダーで全期間を見る）
+            .gte("date", (dt.date.today() - dt.timedelta(days=365)).isoformat())
             .order("date")
             .order("set_no")
             .execute()
@@ -320,6 +358,55 @@ def db_load_sets(user_id: str) -> pd.DataFrame:
 
     return normalize_sets_df(pd.DataFrame(res.data))
 
+@st.cache_data(ttl=60, show_spinner=False)
+def db_load_last_session(user_id: str, exercise: str, before_date: str) -> pd.DataFrame:
+    """指定メニューの「前回セッション」の行だけをDB側で絞って取得"""
+    res = (
+        supabase.table("workouts")
+        .select("id, user_id, date, exercise, bodypart, set_no, weight_kg, reps, note, ts")
+        .eq("user_id", user_id)
+        .eq("exercise", exercise)
+        .lt("date", before_date)
+        .order("date", desc=True)
+        .order("set_no", desc=True)
+        .limit(30)
+        .execute()
+    )
+    df = normalize_sets_df(pd.DataFrame(res.data))
+    if df.empty:
+        return df
+    return df.loc[df["date"] == df["date"].max()]  # 最新日のセッションだけ残す
+
+@st.cache_data(ttl=60, show_spinner=False)
+def db_load_hist_best(user_id: str, before_date: str) -> pd.Series:
+    """メニュー別の過去ベスト1RM。PR判定用なので365日窓はかけず、列だけ絞って取得"""
+    res = (
+        supabase.table("workouts")
+        .select("exercise, weight_kg, reps")
+        .eq("user_id", user_id)
+        .lt("date", before_date)
+        .gt("reps", 0)
+        .execute()
+    )
+    df = pd.DataFrame(res.data)
+    if df.empty:
+        return pd.Series(dtype="float64")
+    return (df.assign(e1rm=_e1rm_vec(df["weight_kg"], df["reps"]))
+              .groupby("exercise")["e1rm"].max())
+
+@st.cache_data(ttl=60, show_spinner=False)
+def db_load_sets_all(user_id: str) -> pd.DataFrame:
+    """CSVエクスポート用の全履歴（窓なし）。ダウンロードのクリック時にだけ呼ばれる"""
+    res = (
+        supabase.table("workouts")
+        .select("id, user_id, date, exercise, bodypart, set_no, weight_kg, reps, note, ts")
+        .eq("user_id", user_id)
+        .order("date")
+        .order("set_no")
+        .execute()
+    )
+    return normalize_sets_df(pd.DataFrame(res.data))
+
 def db_insert_set(user_id: str, row: dict):
     import datetime as dt
     clean = dict(row)  # 破壊しないようコピー
@@ -349,8 +436,13 @@ def db_insert_set(user_id: str, row: dict):
 
     # 挿入
     supabase.table("workouts").insert(clean).execute()
+    db_load_sets.clear()          # キャッシュを無効化して次のrerunで読み直す
+    db_load_last_session.clear()
+    db_load_hist_best.clear()
+    db_load_sets_all.clear()
 
 
+@st.cache_data(ttl=60, show_spinner=False)
 def db_load_bw(user_id):
     res = supabase.table("bodyweight").select("*").eq("user_id", user_id).order("date").execute()
     df = pd.DataFrame(res.data)
@@ -365,16 +457,153 @@ def db_insert_bw(user_id: str, date_obj, bw_kg):
         "date": date_obj.isoformat(),     # ← ここ
         "bodyweight_kg": float(bw_kg),
     }).execute()
+    db_load_bw.clear()  # キャッシュを無効化して次のrerunで読み直す
+
+# --- 種目マスター（user_exercise_master: user_id / bodypart / exercise / position） ---
+# テーブルが未作成の環境では従来のローカルJSONで動き続ける（フォールバック）。
+# バックアップコピーは廃止（DB側はPostgresのPITRでカバー）。
+
+def db_load_ex_master(user_id: str) -> dict:
+    """DBから種目マスターを構築。テーブルが無ければJSON版へフォールバック"""
+    try:
+        res = (
+            supabase.table("user_exercise_master")
+            .select("bodypart, exercise, position")
+            .eq("user_id", user_id)
+            .order("bodypart")
+            .order("position")
+            .execute()
+        )
+    except APIError:
+        return load_ex_master(_ex_master_mtime())
+    rows = res.data or []
+    if not rows:
+        # 初回はローカルJSON（無ければデフォルト）をDBへ移行
+        data = load_ex_master(_ex_master_mtime())
+        for bp, lst in data.items():
+            db_save_ex_master_part(user_id, bp, lst)
+        return data
+    data = {k: [] for k in DEFAULT_EX}
+    for r in rows:
+        data.setdefault(r["bodypart"], [])
+        if r.get("exercise"):
+            data[r["bodypart"]].append(r["exercise"])
+    for k in data:
+        data[k] = _dedup_keep_order(data[k])
+    return data
+
+def db_save_ex_master_part(user_id: str, bodypart: str, exercises: list):
+    """1部位ぶんの行だけ入れ替える（マスター全体は書かない）"""
+    supabase.table("user_exercise_master").delete() \
+        .eq("user_id", user_id).eq("bodypart", bodypart).execute()
+    rows = [
+        {"user_id": user_id, "bodypart": bodypart, "exercise": ex, "position": i}
+        for i, ex in enumerate(exercises)
+    ] or [{"user_id": user_id, "bodypart": bodypart, "exercise": None, "position": 0}]
+    supabase.table("user_exercise_master").insert(rows).execute()
+
+def db_delete_ex_master_part(user_id: str, bodypart: str):
+    supabase.table("user_exercise_master").delete() \
+        .eq("user_id", user_id).eq("bodypart", bodypart).execute()
+
+def persist_ex_master_part(user_id: str, bodypart: str, exercises=None):
+    """変更のあった部位だけDBへ書く。exercises=Noneは部位ごと削除。
+    保存済みスナップショットと同一なら書き込み自体をスキップ。
+    テーブルが無い環境では従来どおりJSONへ全保存する"""
+    saved = st.session_state.setdefault("ex_master_saved", {})
+    new = tuple(exercises) if exercises is not None else None
+    if bodypart in saved and saved[bodypart] == new:
+        return  # 実質変更なし（既存部位の再追加・重複メニュー追加など）
+    try:
+        if exercises is None:
+            db_delete_ex_master_part(user_id, bodypart)
+            saved.pop(bodypart, None)
+        else:
+            db_save_ex_master_part(user_id, bodypart, exercises)
+            saved[bodypart] = new
+    except APIError:
+        save_ex_master(st.session_state["ex_master"])
+
+# セッション1RMはDB側のビューを優先して読む（集計済みの小さな結果だけ転送）。
+# マテビューはRLSポリシーを持てず、publicスキーマに置くと全ユーザーから
+# 他人の履歴がSELECTできてしまうため、security_invokerのビューにして
+# workouts側のRLSをそのまま適用する（リフレッシュも不要になる）。
+# 必要なSQL（Supabase SQL Editorで1回実行）:
+#   CREATE VIEW session_1rm WITH (security_invoker = true) AS
+#     SELECT user_id, date, exercise,
+#            MAX(weight_kg * (1 + reps / 30.0)) AS session_1rm
+#       FROM workouts WHERE reps > 0 GROUP BY 1, 2, 3;
+#   -- workouts(user_id, date) にインデックスがあれば十分軽い
+@st.cache_data(ttl=60, show_spinner=False)
+def load_session_1rm(user_id: str, cache_key) -> pd.DataFrame:
+    """日付×メニューごとのセッション最大1RM（cache_keyはsetsの世代）"""
+    try:
+        res = (
+            supabase.table("session_1rm")
+            .select("date, exercise, session_1rm")
+            .eq("user_id", user_id)
+            # フォールバック（db_load_sets由来）と同じ365日窓を揃える
+            .gte("date", (dt.date.today() - dt.timedelta(days=365)).isoformat())
+            .order("date")
+            .execute()
+        )
+        df = pd.DataFrame(res.data)
+        if not df.empty:
+            df["date"] = pd.to_datetime(df["date"], errors="coerce")
+            df["session_1rm"] = pd.to_numeric(df["session_1rm"], errors="coerce")
+            return df
+    except APIError:
+        pass  # ビュー未作成の環境ではクライアント側で集計
+
+    df = db_load_sets(user_id)
+    if df.empty:
+        return pd.DataFrame(columns=["date", "exercise", "session_1rm"])
+    # 必要な列だけの射影にe1rmを足す（全列のディープコピーを作らない）
+    return (df[["date", "exercise"]]
+              .assign(e1rm=_e1rm_vec(df["weight_kg"], df["reps"]))
+              .dropna(subset=["e1rm"])
+              .groupby(["date", "exercise"], as_index=False, observed=True)["e1rm"].max()
+              .rename(columns={"e1rm": "session_1rm"}))
+
+def load_dashboard(user_id: str):
+    """workouts / bodyweight の2リクエストを並行で投げる（直列だとRTT×2かかる）"""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        f_sets = pool.submit(db_load_sets, user_id)
+        f_bw   = pool.submit(db_load_bw, user_id)
+        return f_sets.result(), f_bw.result()
 
 
 # ========== Initial Load ==========
-ex_master = load_ex_master()
-sets = db_load_sets(USER_ID)
-bw   = db_load_bw(USER_ID)
+# 種目マスターはセッション内にキャッシュ（DBは初回の1回だけ）
+if "ex_master" not in st.session_state:
+    st.session_state["ex_master"] = db_load_ex_master(USER_ID)
+    # 保存済みスナップショット（no-op書き込みのスキップ判定に使う）
+    st.session_state["ex_master_saved"] = {
+        bp: tuple(lst) for bp, lst in st.session_state["ex_master"].items()
+    }
+ex_master = st.session_state["ex_master"]
+
+sets, bw = load_dashboard(USER_ID)
 
 # ← ここで正規化（必須）
 sets = normalize_sets_df(sets)
 
+# (exercise, date)で一度だけソートし、種目ごとの行位置インデックスを持つ。
+# 以降の「この種目×この日」の切り出しは二分探索（searchsorted）で済み、
+# rerunごとの全行ブールマスク走査が要らなくなる
+sets_sorted = sets.sort_values(["exercise", "date", "set_no"]).reset_index(drop=True)
+_grp_idx = sets_sorted.groupby("exercise", observed=True).indices
+
+def slice_ex_day(exercise: str, day) -> pd.DataFrame:
+    """sets_sortedから指定メニュー×指定日の行をO(log N)で切り出す"""
+    idx = _grp_idx.get(exercise)
+    if idx is None:
+        return sets_sorted.iloc[0:0]
+    dates = sets_sorted["date"].values[idx]
+    lo = np.searchsorted(dates, pd.Timestamp(day).to_datetime64(), side="left")
+    hi = np.searchsorted(dates, (pd.Timestamp(day) + pd.Timedelta(days=1)).to_datetime64(), side="left")
+    return sets_sorted.iloc[idx[lo:hi]]
+
 # 部位が変わったらメニュー選択をリセットして先頭に合わせる
 def _on_bp_change():
     bp_now = st.session_state.get("bp_main")
@@ -392,9 +621,8 @@ with st.sidebar.expander("部位の管理"):
     if st.button("部位を追加", key="bp_add_btn"):
         name = (new_bp or "").strip()
         if name:
-            backup_before_master_edit()
             ex_master.setdefault(name, [])
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, name, ex_master[name])
             st.success(f"部位「{name}」を追加しました。")
 
     bp_old = st.selectbox("改名する部位", options=list(ex_master.keys()), key="bp_old")
@@ -402,18 +630,18 @@ with st.sidebar.expander("部位の管理"):
     if st.button("部位名を変更", key="bp_rename_btn"):
         old, new = bp_old, (bp_new or "").strip()
         if new and old in ex_master:
-            backup_before_master_edit()
             ex_master[new] = ex_master.pop(old)
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, old)  # 旧名の行を削除
+            persist_ex_master_part(USER_ID, new, ex_master[new])
             st.success(f"部位名を「{old}」→「{new}」に変更しました。")
 
     bp_del = st.selectbox("削除する部位", options=list(ex_master.keys()), key="bp_del")
     if st.button("部位を削除", key="bp_del_btn"):
         if bp_del in ex_master and bp_del != "未分類":
-            backup_before_master_edit()
             ex_master["未分類"] = _dedup_keep_order(ex_master.get("未分類", []) + ex_master[bp_del])
             ex_master.pop(bp_del, None)
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, bp_del)
+            persist_ex_master_part(USER_ID, "未分類", ex_master["未分類"])
             st.success(f"部位「{bp_del}」を削除（メニューは未分類へ退避）しました。")
         else:
             st.warning("「未分類」は削除できません。")
@@ -426,9 +654,8 @@ with st.sidebar.expander("メニューの管理"):
     if st.button("メニューを追加", key="ex_add_btn"):
         name = (ex_add or "").strip()
         if name:
-            backup_before_master_edit()
             ex_master[bp_sel] = _dedup_keep_order(ex_list + [name])
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, bp_sel, ex_master[bp_sel])
             st.success(f"「{bp_sel}」に「{name}」を追加しました。")
 
     ex_old = st.selectbox("改名するメニュー", options=ex_list, key="ex_old")
@@ -436,39 +663,45 @@ with st.sidebar.expander("メニューの管理"):
     if st.button("メニュー名を変更", key="ex_rename_btn"):
         new = (ex_new or "").strip()
         if ex_old and new:
-            backup_before_master_edit()
             ex_master[bp_sel] = [new if x == ex_old else x for x in ex_master[bp_sel]]
             ex_master[bp_sel] = _dedup_keep_order(ex_master[bp_sel])
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, bp_sel, ex_master[bp_sel])
             st.success(f"メニュー名を「{ex_old}」→「{new}」に変更しました。")
 
     ex_mv = st.selectbox("移動するメニュー", options=ex_list, key="ex_mv")
     mv_to = st.selectbox("移動先の部位", options=[k for k in ex_master.keys() if k != bp_sel], key="mv_to")
     if st.button("移動", key="ex_move_btn"):
         if ex_mv and mv_to:
-            backup_before_master_edit()
             ex_master[bp_sel] = [x for x in ex_master[bp_sel] if x != ex_mv]
             ex_master[mv_to]  = _dedup_keep_order(ex_master.get(mv_to, []) + [ex_mv])
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, bp_sel, ex_master[bp_sel])
+            persist_ex_master_part(USER_ID, mv_to, ex_master[mv_to])
             st.success(f"「{ex_mv}」を「{bp_sel}」→「{mv_to}」へ移動しました。")
 
     ex_del = st.multiselect("削除するメニュー（ログは残す）", options=ex_list, key="ex_del")
     if st.button("メニューを削除", key="ex_del_btn"):
         if ex_del:
-            backup_before_master_edit()
             ex_master[bp_sel] = [x for x in ex_list if x not in set(ex_del)]
-            save_ex_master(ex_master)
+            persist_ex_master_part(USER_ID, bp_sel, ex_master[bp_sel])
             st.success("メニューを削除しました。（過去の記録は残ります）")
 
 # オプション：DBの現在データをCSVでDL（“今見てる自分のデータ”を書き出す）
+def _csv_bytes(df: pd.DataFrame) -> bytes:
+    # バイナリバッファへ直接書き、str→bytesの中間コピーを作らない
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False)
+    return buf.getvalue()
+
+# data=にcallableを渡すとクリック時にだけCSV生成される（rerunごとの変換を省く）
+# workouts.csv はバックアップ用途なので365日窓をかけない全履歴を書き出す
 st.sidebar.download_button(
     "workouts.csv をダウンロード",
-    data=db_load_sets(USER_ID).to_csv(index=False).encode("utf-8"),
+    data=lambda: _csv_bytes(db_load_sets_all(USER_ID)),
     file_name="workouts.csv", mime="text/csv"
 )
 st.sidebar.download_button(
     "bodyweight.csv をダウンロード",
-    data=db_load_bw(USER_ID).to_csv(index=False).encode("utf-8"),
+    data=lambda: _csv_bytes(bw),
     file_name="bodyweight.csv", mime="text/csv"
 )
 
@@ -497,62 +730,49 @@ with colL:
         st.session_state["selected_exercise"] = ""        # 候補が無いときは空に
     
     # ===== 前回の記録（選択メニュー × 選択日より前の最新）を即時表示 =====
-    date_ser = pd.to_datetime(sets.get("date"), errors="coerce")
-    try: date_ser = date_ser.dt.tz_localize(None)
-    except Exception: pass
-
     sel_date = st.session_state["selected_date"]
-    
-    date_ts = pd.to_datetime(date, errors="coerce")
-    try: date_ts = date_ts.tz_localize(None)
-    except Exception: pass
-    
-    ex_ser = sets.get("exercise")
-    
+
     # 1) 今日の同メニューの記録（当日の最新を優先したいので先に作る）
-    today_mask = (sets.get("exercise") == ex_sel) & (date_ser.dt.date == sel_date)
-    today_df   = sets.loc[today_mask]
-    
-    # 2) 「前回セッション」（選択日より前で最新）を表示するためのデータ
-    prev_mask = (ex_ser == ex_sel) & (date_ser < date_ts)
-    
-    if ex_sel and not sets.empty and prev_mask.any():
-        prev_day_ts = date_ser[prev_mask].max()
-        sel_mask = (ex_ser == ex_sel) & (date_ser == prev_day_ts)
-        prev_df = sets.loc[sel_mask].copy()
-    
-        prev_df["e1rm"] = prev_df.apply(lambda r: est_1rm_epley(r["weight_kg"], r["reps"]), axis=1)
+    #    ソート済みインデックス＋二分探索で取り出す（全行マスク不要）
+    today_df = slice_ex_day(ex_sel, sel_date) if ex_sel else sets.iloc[0:0]
+
+    # 2) 「前回セッション」はDB側で絞って取得（全履歴のクライアント走査をやめる）
+    #    表示とデフォ値で使い回す
+    prev_rows = db_load_last_session(USER_ID, ex_sel, date.isoformat()) if ex_sel else pd.DataFrame()
+    prev_day_ts = prev_rows["date"].max() if not prev_rows.empty else pd.NaT
+
+    if not prev_rows.empty:
+        prev_df = prev_rows.copy()
+        prev_df["e1rm"] = _e1rm_vec(prev_df["weight_kg"], prev_df["reps"])
         prev_df = (prev_df.sort_values("set_no")
                           [["set_no","weight_kg","reps","e1rm","note"]]
                           .rename(columns={"set_no":"セット","reps":"回数","e1rm":"1RM(kg)","note":"メモ"}))
         if "weight_kg" in prev_df.columns:
             prev_df = prev_df.rename(columns={"weight_kg":"重量(kg)"})
         prev_df.insert(0, "種目", ex_sel)
-    
+
         prev_best = prev_df["1RM(kg)"].max()
         st.markdown(f"**前回（{prev_day_ts.date()}）の記録**　セッション1RM: **{prev_best:.1f} kg**")
         st.dataframe(prev_df, hide_index=True, use_container_width=True)
     else:
         st.caption("前回の記録：なし（このメニューは初回）")
-    
+
     # 3) 次セット番号（当日の既存セット数から）
-    exist = today_df
-    cur_max = pd.to_numeric(exist.get("set_no"), errors="coerce").max() if not exist.empty else pd.NA
+    cur_max = pd.to_numeric(today_df.get("set_no"), errors="coerce").max() if not today_df.empty else pd.NA
     next_set_no = int(cur_max) + 1 if pd.notna(cur_max) else 1
     st.caption(f"今回のセット番号: **{next_set_no}**（自動採番）")
-    
+
     # 4) 入力デフォ値（優先順：今日の最新 → 前回の最後 → 0/1）
     last_w, last_r = 0.0, 1
-    if not today_df.empty:
-        _tlast = today_df.sort_values("set_no").tail(1)
-        last_w = float(pd.to_numeric(_tlast["weight_kg"], errors="coerce").iloc[0] or 0.0)
-        last_r = int(pd.to_numeric(_tlast["reps"], errors="coerce").iloc[0] or 1)
-    elif ex_sel and not sets.empty and prev_mask.any():
-        prev_day_ts = date_ser[prev_mask].max()
-        _plast = sets.loc[(ex_ser == ex_sel) & (date_ser == prev_day_ts)].sort_values("set_no").tail(1)
-        if not _plast.empty:
-            last_w = float(pd.to_numeric(_plast["weight_kg"], errors="coerce").iloc[0] or 0.0)
-            last_r = int(pd.to_numeric(_plast["reps"], errors="coerce").iloc[0] or 1)
+    _src = today_df if not today_df.empty else prev_rows
+    if not _src.empty:
+        # set_no最大の行を位置で特定し、.iatでスカラー2つだけ読む
+        # （sort→copy→tailでサブDataFrameを作らない）
+        pos = int(np.argmax(_src["set_no"].fillna(-1).to_numpy(dtype="float64")))
+        w = _src["weight_kg"].iat[pos]
+        r = _src["reps"].iat[pos]
+        last_w = float(w) if pd.notna(w) and w else 0.0
+        last_r = int(r) if pd.notna(r) and r else 1
     
     # --- フォーム内：送信で確定する値だけ ---
     with st.form("add_set", clear_on_submit=True):
@@ -585,7 +805,7 @@ with colL:
     
             if ex_new.strip():
                 ex_master[bp] = _dedup_keep_order(ex_master.get(bp, []) + [exercise])
-                save_ex_master(ex_master)
+                persist_ex_master_part(USER_ID, bp, ex_master[bp])
     
             st.success("セットを追加しました。")
             st.rerun()
@@ -610,8 +830,10 @@ with colL:
 
 
 # ---- 最新データを再ロード（DBから） ----
-sets = db_load_sets(USER_ID)
-bw   = db_load_bw(USER_ID)
+sets, bw = load_dashboard(USER_ID)
+
+# セッション1RM集計は全チャートで共有（3回あった同一スキャンを1回に）
+ses = load_session_1rm(USER_ID, (len(sets), str(sets["ts"].max()) if not sets.empty else ""))
 
 # ========== Views ==========
 # 当日のセット一覧（色付け & PR）
@@ -629,13 +851,15 @@ except Exception:
     pass
 
 # 当日のレコード（全メニュー）
-today_sets = sets.loc[date_ser.dt.date == day].copy()
+# assignは列バッファを共有した浅いコピーを返す（.copy()のフル複製を避ける）
+today_sets = sets.loc[date_ser.dt.date == day]
+# e1rmは必要になったこの時点で一度だけ付与（ローダーやCSV出力には持たせない）
+today_sets = today_sets.assign(e1rm=_e1rm_vec(today_sets["weight_kg"], today_sets["reps"]))
 
 # ===== その日の“選択メニュー”のセットごとの1RM推移（あれば） =====
 if sel_ex:
-    ex_today = today_sets.loc[today_sets["exercise"] == sel_ex].copy()
+    ex_today = today_sets.loc[today_sets["exercise"] == sel_ex]
     if not ex_today.empty:
-        ex_today["e1rm"] = ex_today.apply(lambda r: est_1rm_epley(r["weight_kg"], r["reps"]), axis=1)
         ex_today = ex_today.sort_values("set_no")
 
         ex_today["set_no"] = pd.to_numeric(ex_today["set_no"], errors="coerce").fillna(0).astype(int)
@@ -670,58 +894,41 @@ if today_sets.empty:
     st.info("この日付の記録はありません。上のフォームで追加してください。")
 else:
     # 以降は従来の「当日のセット一覧（全メニュー）」とPR判定
-    today_sets["e1rm"] = today_sets.apply(lambda r: est_1rm_epley(r["weight_kg"], r["reps"]), axis=1)
-
-    # 過去（選択日より前）
-    day_ts = pd.to_datetime(day, errors="coerce")
-    history = sets.loc[date_ser < day_ts].copy()
-    if not history.empty:
-        history["e1rm"] = history.apply(lambda r: est_1rm_epley(r["weight_kg"], r["reps"]), axis=1)
-
-    best_hist = (
-        history.dropna(subset=["e1rm"])
-               .sort_values(["exercise","e1rm"], ascending=[True, False])
-               .groupby("exercise", as_index=True)
-               .first()[["e1rm"]]
-               .rename(columns={"e1rm":"hist_best"})
+    # 過去ベストは365日窓のかかったsetsではなく、全期間をDB側で絞った専用ローダーから
+    # 取得する（窓内だけ見ると1年以上前のベストを超えていないのにPR扱いになる）
+    hist_best = db_load_hist_best(USER_ID, day.isoformat())
+
+    # セッションベスト／PRを列演算で一括判定（メニューごとのPythonループを排除）
+    session_best = today_sets.groupby("exercise")["e1rm"].transform("max")
+    today_sets["is_best"] = today_sets["e1rm"] == session_best
+    today_sets["is_pr"] = today_sets["is_best"] & (
+        session_best > today_sets["exercise"].map(hist_best).fillna(-np.inf) + EPS
     )
 
-    for ex in sorted(today_sets["exercise"].unique()):
-        ex_df = today_sets[today_sets["exercise"] == ex].sort_values("set_no")
+    for ex, ex_df in today_sets.sort_values("set_no").groupby("exercise", observed=True):
         max_e1rm = ex_df["e1rm"].max()
         st.markdown(f"### {ex}（当日セッション1RM: **{max_e1rm:.1f} kg**）")
 
-        hist_best_val = best_hist.loc[ex, "hist_best"] if ex in best_hist.index else None
-        is_pr_day = (hist_best_val is None) or (max_e1rm > (hist_best_val + EPS))
-        best_idx = ex_df["e1rm"].idxmax()
-
-        for idx, row in ex_df.iterrows():
-            e1 = row["e1rm"]
-            is_session_best = (idx == best_idx)
-            color = "red" if is_session_best else "black"
-            show_pr = is_session_best and is_pr_day
-            pr_badge = " 🏆 **PR更新**" if show_pr else ""
-            st.markdown(
-                f"- セット{int(row['set_no'])}: {row['weight_kg']} kg × {int(row['reps'])} rep "
-                f"｜ 1RM推定: <span style='color:{color}'><strong>{e1:.1f} kg</strong></span>{pr_badge} "
-                f"｜ メモ: {row['note']}",
-                unsafe_allow_html=True
-            )
+        # 1メニュー=1つのst.dataframe（セットごとのst.markdown連打をやめる）
+        best_flags = ex_df["is_best"].to_numpy()
+        view = (ex_df.assign(PR=np.where(ex_df["is_pr"], "🏆 PR", ""))
+                     [["set_no", "weight_kg", "reps", "e1rm", "PR", "note"]]
+                     .rename(columns={"set_no": "セット", "weight_kg": "重量(kg)",
+                                      "reps": "回数", "e1rm": "1RM(kg)", "note": "メモ"})
+                     .reset_index(drop=True))
+        styled = (view.style
+                      .apply(lambda r: ["color:red"] * len(r) if best_flags[r.name] else [""] * len(r), axis=1)
+                      .format({"1RM(kg)": "{:.1f}"}, na_rep="-"))
+        st.dataframe(styled, hide_index=True, use_container_width=True)
 
 
 
 # メニュー別：セッション最大1RM 推移
 st.divider()
 st.subheader("メニュー別：セッション最大1RM の推移")
-if sets.empty:
+if ses.empty:
     st.info("データがありません。")
 else:
-    tmp = sets.copy()
-    tmp["e1rm"] = tmp.apply(lambda r: est_1rm_epley(r["weight_kg"], r["reps"]), axis=1)
-    ses = (tmp.dropna(subset=["e1rm"])
-              .groupby(["date","exercise"], as_index=False)["e1rm"].max()
-              .rename(columns={"e1rm":"session_1rm"}))
-
     ex_opts = sorted(ses["exercise"].unique().tolist())
     chosen_ex = st.multiselect("表示するメニュー", options=ex_opts, default=ex_opts[:1] if ex_opts else [])
     if not chosen_ex:
@@ -745,15 +952,9 @@ else:
 # オーバーレイ：体重 or 別メニュー1RM
 st.divider()
 st.subheader("オーバーレイ：体重 または 別メニューの1RMを重ねる")
-if sets.empty:
+if ses.empty:
     st.info("データがありません。")
 else:
-    tmp = sets.copy()
-    tmp["e1rm"] = tmp.apply(lambda r: est_1rm_epley(r["weight_kg"], r["reps"]), axis=1)
-    ses = (tmp.dropna(subset=["e1rm"])
-              .groupby(["date","exercise"], as_index=False)["e1rm"].max()
-              .rename(columns={"e1rm":"session_1rm"}))
-
     c1, c2, c3 = st.columns(3)
     with c1:
         base_ex = st.selectbox("メイン軸：メニュー（1RM）", options=sorted(ses["exercise"].unique()) if not ses.empty else [])
@@ -774,6 +975,9 @@ else:
             st.warning("体重データがありません。右側のフォームから体重を記録してください。")
         else:
             bw_series = bw[["date","bodyweight_kg"]].copy()
+            bw_series["date"] = pd.to_datetime(bw_series["date"])
+            # 1つのデータセットを両レイヤーで共有（2つ分のJSONを送らない）
+            merged = base_df.merge(bw_series, on="date", how="outer")
             dom_base = y_domain(base_df[f"{base_ex}_1RM"])
             dom_bw   = y_domain(bw_series["bodyweight_kg"])
             y_base = alt.Y(f"{base_ex}_1RM:Q", title=f"{base_ex} 1RM (kg)",
@@ -786,12 +990,13 @@ else:
                         axis=alt.Axis(titleColor="#ff7f0e"),
                         scale=alt.Scale(domain=dom_bw, zero=False, nice=False))
 
+            base_chart = alt.Chart(merged)
             chart = alt.layer(
-                alt.Chart(base_df).mark_line(point=True).encode(
+                base_chart.mark_line(point=True).encode(
                     x=alt.X("date:T", title="日付"),
                     y=y_base
                 ),
-                alt.Chart(bw_series).mark_line(point=True).encode(
+                base_chart.mark_line(point=True).encode(
                     x=alt.X("date:T"),
                     y=y_bw,
                     color=alt.value("#ff7f0e")
@@ -804,7 +1009,9 @@ else:
             st.info("重ねるメニューを選んでください。")
         else:
             ov = ses[ses["exercise"] == overlay_ex][["date","session_1rm"]].rename(columns={"session_1rm": f"{overlay_ex}_1RM"})
-            
+            # こちらも1つのデータセットを両レイヤーで共有
+            merged = base_df.merge(ov, on="date", how="outer")
+
             dom_base = y_domain(base_df[f"{base_ex}_1RM"])
             dom_ov   = y_domain(ov[f"{overlay_ex}_1RM"])
             y_base = alt.Y(f"{base_ex}_1RM:Q", title=f"{base_ex} 1RM (kg)",
@@ -815,12 +1022,13 @@ else:
                         scale=alt.Scale(domain=dom_ov, zero=False, nice=False))
 
             
+            base_chart = alt.Chart(merged)
             chart = alt.layer(
-                alt.Chart(base_df).mark_line(point=True).encode(
+                base_chart.mark_line(point=True).encode(
                     x=alt.X("date:T", title="日付"),
                     y=y_base
                 ),
-                alt.Chart(ov).mark_line(point=True).encode(
+                base_chart.mark_line(point=True).encode(
                     x=alt.X("date:T"),
                     y=y_ov,
                     color=alt.value("#ff7f0e")